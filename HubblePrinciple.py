@@ -1,6 +1,17 @@
-import matplotlib.pyplot as plt
+import matplotlib
+import numpy as np
+import os
 import sys
-from Core import RK4FirstOrder
+
+# Set HUBBLE_HEADLESS (to anything other than an empty string or 0) to save the graphs to
+# test1.png, test2.png, ... instead of opening windows, e.g. for timing runs or machines without
+# a display.  The backend has to be chosen before pyplot is imported.
+#
+headless = os.environ.get('HUBBLE_HEADLESS', '') not in ('', '0')
+if headless:
+    matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
 from Core import Euler 
 from Core import PhysicalQuantity
 
@@ -11,20 +22,35 @@ parsecsInMpc = 1e6
 distanceMpc = 1e2
 speedOfLight = 299792458
 
+# Number of time steps it would take to cover twice the initial distance.
+#
+stepsPerDoubleCrossing = 1000000
+
+# Conversion factors, worked out once here rather than every time a conversion is made.
+#
+metresInMpc = metresInParsec * parsecsInMpc
+mpcInMetre = 1 / metresInMpc
+secondsInYear = 365.25 * 60 * 60 * 24
+yearsInSecond = 1 / secondsInYear
+
+# Roughly the most points a plot can show, so there's no point keeping a longer history.
+#
+plotPoints = 4096
+
 def metresToMpc(metres):
-    return metres / (metresInParsec * parsecsInMpc)
+    return metres * mpcInMetre
 
 def hubbleToSi(hubble):
-    return hubble / (metresInParsec * parsecsInMpc)
+    return hubble * mpcInMetre
 
 def MpcToMetres(distanceMpc):
-    return distanceMpc * metresInParsec * parsecsInMpc
+    return distanceMpc * metresInMpc
 
 def yearsToSeconds(years):
-    return years * 365.25 * 60 * 60 * 24
+    return years * secondsInYear
 
 def secondsToYears(seconds):
-    return seconds / (60 * 60 * 24 * 365.25)
+    return seconds * yearsInSecond
 
 # A generic universe that defines the Hubble parameter as a function of time.
 #
@@ -35,44 +61,129 @@ class Universe():
     def Hubble(self, Time):
         return 1
 
-class StaticUniverse(Universe):
-    def __init__(self):
-        Universe.__init__(self, "Static Hubble parameter")
-        HubbleConstant = 70e3
-        self.HubbleConstantSiUnits = hubbleToSi(HubbleConstant)
+# A universe where the Hubble parameter changes linearly with time.  Describing it by these two
+# numbers lets the simulation use the exact solution instead of calling Hubble.
+#
+class LinearHubbleUniverse(Universe):
+    def __init__(self, name, HubbleConstantTimeZero, HubbleConstantRateOfChange):
+        Universe.__init__(self, name)
+        self.HubbleConstantTimeZero = HubbleConstantTimeZero
+        self.HubbleConstantRateOfChange = HubbleConstantRateOfChange
 
     def Hubble(self, Time):
-        return self.HubbleConstantSiUnits
+        return self.HubbleConstantRateOfChange * Time + self.HubbleConstantTimeZero
+
+class StaticUniverse(LinearHubbleUniverse):
+    def __init__(self):
+        HubbleConstant = 70e3
+        LinearHubbleUniverse.__init__(self, "Static Hubble parameter", hubbleToSi(HubbleConstant), 0)
         
-class LinearDecreaseWithTimeUniverse(Universe):
+class LinearDecreaseWithTimeUniverse(LinearHubbleUniverse):
     def __init__(self):
-        Universe.__init__(self, "Hubble parameter decreasing linearly with time")
-
         # Assume that the Hubble constant has decreased from at the big bang to its current value
         # in a linear manner.
         HubbleConstantNow = 70e3
         HubbleConstantSiUnitsNow = hubbleToSi(HubbleConstantNow)
-        self.HubbleConstantTimeZero = hubbleToSi(speedOfLight)
+        HubbleConstantTimeZero = hubbleToSi(speedOfLight)
         TimeNow = 13.8e9
         TimeNowSeconds = yearsToSeconds(TimeNow)
-        self.HubbleConstantRateOfChange = (HubbleConstantSiUnitsNow - self.HubbleConstantTimeZero) / TimeNowSeconds
+        HubbleConstantRateOfChange = (HubbleConstantSiUnitsNow - HubbleConstantTimeZero) / TimeNowSeconds
+        LinearHubbleUniverse.__init__(self, "Hubble parameter decreasing linearly with time", HubbleConstantTimeZero, HubbleConstantRateOfChange)
 
-    def Hubble(self, Time):
-        return self.HubbleConstantRateOfChange * Time + self.HubbleConstantTimeZero
+# With a constant Hubble parameter dD/dt = H * D - v has the closed form
+# D(t) = D0 * exp(H * t) - (v / H) * (exp(H * t) - 1), so the static universe needs no
+# numerical integration at all.  The moving object arrives when exp(H * t) = v / (v - H * D0),
+# so the grid can be sized to finish exactly on arrival.  Rounding right at the edge of the
+# observable universe can still leave no finite arrival time, which is reported the same way.
+#
+def SolveStaticUniverse(InitialDisplacement, Velocity, Hubble, TimeStep):
+    with np.errstate(divide='ignore'):
+        ArrivalTime = -np.log1p(-Hubble * InitialDisplacement / Velocity) / Hubble
+    if not (np.isfinite(ArrivalTime) and ArrivalTime > 0):
+        print("Distance outside observable universe")
+        return None
+
+    Timestamps = np.linspace(0, ArrivalTime, int(np.ceil(ArrivalTime / TimeStep)) + 1)
 
-# An object that is moving relative to another one.  In reality we can define any object as stationary.
+    growth = np.expm1(Hubble * Timestamps)
+    Displacements = InitialDisplacement + (InitialDisplacement - Velocity / Hubble) * growth
+    DistancesFromStart = (Velocity / Hubble) * growth
+    return Timestamps, Displacements, DistancesFromStart
+
+# For H(t) = rate * t + H0 the integrating factor mu(t) = exp(-(rate * t^2 / 2 + H0 * t)) gives
+# D(t) = (D0 - v * integral of mu) / mu, so a linear universe doesn't need stepping either.  The
+# integral is accumulated with the trapezium rule over the time grid.
+#
+def LinearUniverseSolution(Timestamps, InitialDisplacement, Velocity, HubbleTimeZero, HubbleRateOfChange):
+    integratingFactor = np.exp(-(HubbleRateOfChange / 2 * Timestamps + HubbleTimeZero) * Timestamps)
+    integral = np.zeros(len(Timestamps))
+    np.cumsum((integratingFactor[1:] + integratingFactor[:-1]) * np.diff(Timestamps) / 2, out=integral[1:])
+    Displacements = (InitialDisplacement - Velocity * integral) / integratingFactor
+    DistancesFromStart = Velocity * integral / integratingFactor
+    return Displacements, DistancesFromStart
+
+# The integral has no convenient closed form, so the arrival time is found on a coarse grid
+# (doubled until it reaches arrival) and interpolated within the step where the displacement
+# changes sign.  The solution is then evaluated once on a grid that finishes exactly there.  The
+# search gives up at MaxTime, or sooner if the integrating factor underflows and the displacement
+# can no longer be represented, since the destination is then running away.
 #
-class MovingObject():
-    def __init__(self, initialDisplacement, initialVelocity, universe):
-        self.Displacement = initialDisplacement
-        self.Velocity = initialVelocity 
-        self.Universe = universe
+def SolveLinearUniverse(InitialDisplacement, Velocity, HubbleTimeZero, HubbleRateOfChange, TimeStep, Steps, MaxTime):
+    MaxSteps = int(MaxTime / TimeStep) + 1
+    while True:
+        Timestamps = np.arange(min(Steps, MaxSteps)) * TimeStep
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            Displacements, DistancesFromStart = LinearUniverseSolution(
+                Timestamps, InitialDisplacement, Velocity, HubbleTimeZero, HubbleRateOfChange)
+
+        arrival = np.argmax(Displacements <= 0)
+        if Displacements[arrival] <= 0:
+            break
+        if Steps >= MaxSteps or not np.isfinite(Displacements[-1]):
+            print("Destination not reached after %g years" % secondsToYears(MaxTime))
+            return None
+        Steps *= 2
+
+    before = Displacements[arrival - 1]
+    ArrivalTime = Timestamps[arrival - 1] + TimeStep * before / (before - Displacements[arrival])
+
+    Timestamps = np.linspace(0, ArrivalTime, arrival + 1)
+    Displacements, DistancesFromStart = LinearUniverseSolution(
+        Timestamps, InitialDisplacement, Velocity, HubbleTimeZero, HubbleRateOfChange)
+    return Timestamps, Displacements, DistancesFromStart
+
+# Any other universe is integrated with an adaptive solver.  The solution only changes on a
+# timescale of 1 / H, so LSODA needs a few hundred calls to Hubble where a fixed step RK4 would
+# need millions.  Integration stops at the arrival event and the dense output is sampled onto
+# an evenly spaced grid for plotting.  Nothing is plotted if the destination is never reached,
+# since by MaxTime the runaway trajectory is far beyond anything a plot could show.
+#
+def SolveUniverse(InitialDisplacement, Velocity, universe, MaxTime, Points):
+    # SciPy's integrators take a while to import and the built in universes never need them.
+    #
+    from scipy.integrate import solve_ivp
+
+    def RateOfChangeOfDisplacement(Time, Displacements):
+        hubble = universe.Hubble(Time)
+        return [hubble * Displacements[0] - Velocity, hubble * Displacements[1] + Velocity]
+
+    def Arrived(Time, Displacements):
+        return Displacements[0]
+    Arrived.terminal = True
+    Arrived.direction = -1
 
-    def RateOfChangeOfDisplacement(self, Time, Displacement):
-        return self.Universe.Hubble(Time) * Displacement - self.Velocity
+    solution = solve_ivp(RateOfChangeOfDisplacement, (0, MaxTime), [InitialDisplacement, 0], method='LSODA',
+                         events=Arrived, dense_output=True, rtol=1e-6)
+    if solution.status < 0:
+        print("Integration failed: %s" % solution.message)
+        return None
+    if solution.status == 0:
+        print("Destination not reached after %g years" % secondsToYears(MaxTime))
+        return None
 
-    def Update(self, TimeStep, Time):
-        self.Displacement = RK4FirstOrder(self.Displacement, TimeStep, lambda time, Displacement: self.RateOfChangeOfDisplacement(time, Displacement), Time) 
+    Timestamps = np.linspace(0, solution.t[-1], Points)
+    Displacements, DistancesFromStart = solution.sol(Timestamps)
+    return Timestamps, Displacements, DistancesFromStart
 
 # A dictionary of universes in case anyone wants to specify it as a command line argument.
 #
@@ -80,39 +191,68 @@ universes = {'static' : StaticUniverse(), 'linear' : LinearDecreaseWithTimeUnive
 
 def SimulateConstantVelocityTravel(InitialDisplacement, hubbleModel, testNumber):
     speed = speedOfLight
-    Displacements = []
-    DistancesFromStart = []
-    StartAndEndSeparation = []
-    Timestamps = []
+    if InitialDisplacement <= 0:
+        print("Distance must be greater than zero")
+        return
 
     # Try to use a sensible duration to stop the computer running out of memory.
-    TimeStep = (2 * InitialDisplacement / speedOfLight) / 1e6
+    MaxSteps = stepsPerDoubleCrossing
+    TimeStep = (2 * InitialDisplacement / speedOfLight) / MaxSteps
 
-    time = 0
     universe = universes[hubbleModel]
 
     # Obviously this doesn't actually define the size of the observable universe, but it seems
     # like a reasonable test of whether the simulation will ever finish in most cases.
     #
-    if InitialDisplacement * universe.Hubble(0) > speedOfLight:
+    if InitialDisplacement * universe.Hubble(0) >= speedOfLight:
         print("Distance outside observable universe") 
     else:
         # Simulate the motion of light towards a destination and the motion of the starting
-        # point away from the light.  Note the opposite signs for velocity.
+        # point away from the light.  Note the opposite signs for velocity.  Universes with a
+        # constant or linear Hubble parameter are solved exactly and anything else goes through
+        # the adaptive solver.  Only every stride-th step is kept since a plot can't show more than
+        # plotPoints anyway.
         #
-        movingObject = MovingObject(InitialDisplacement, speedOfLight, universe)
-        startingPoint = MovingObject(0, -speedOfLight, universe)
+        stride = max(1, MaxSteps // plotPoints)
+        SampleStep = TimeStep * stride
 
-        # Run the simulation until we get to where we're going.
+        # Give up on anything that hasn't arrived after a thousand crossings at the speed of light.
         #
-        while movingObject.Displacement > 0:
-            movingObject.Update(TimeStep, time)
-            startingPoint.Update(TimeStep, time)
-            Timestamps.append(secondsToYears(time))    
-            time += TimeStep
-            Displacements.append(metresToMpc(movingObject.Displacement))
-            DistancesFromStart.append(metresToMpc(startingPoint.Displacement))
-            StartAndEndSeparation.append(metresToMpc(movingObject.Displacement) + metresToMpc(startingPoint.Displacement))
+        MaxTime = 1e3 * InitialDisplacement / speedOfLight
+
+        # A universe that doesn't expand at all is left to the linear solver, where the integrating
+        # factor is just 1, since the static solution divides by the Hubble parameter.
+        #
+        if (isinstance(universe, LinearHubbleUniverse) and universe.HubbleConstantRateOfChange == 0
+                and universe.HubbleConstantTimeZero != 0):
+            solution = SolveStaticUniverse(
+                InitialDisplacement, speedOfLight, universe.HubbleConstantTimeZero, SampleStep)
+        elif isinstance(universe, LinearHubbleUniverse):
+            solution = SolveLinearUniverse(
+                InitialDisplacement, speedOfLight, universe.HubbleConstantTimeZero, universe.HubbleConstantRateOfChange,
+                SampleStep, MaxSteps // stride + 1, MaxTime)
+        else:
+            solution = SolveUniverse(InitialDisplacement, speedOfLight, universe, MaxTime, plotPoints)
+
+        if solution is None:
+            return
+        Timestamps, Displacements, DistancesFromStart = solution
+
+        # The distance from the start is only needed for the separation, so build the separation
+        # in its place.  Everything above works in SI units, so convert the whole history in place
+        # in one go.
+        #
+        StartAndEndSeparation = np.add(Displacements, DistancesFromStart, out=DistancesFromStart)
+        Timestamps *= yearsInSecond
+        Displacements *= mpcInMetre
+        StartAndEndSeparation *= mpcInMetre
+
+        # The integration needs double precision but the plot doesn't, and single precision halves
+        # the memory matplotlib has to push through.
+        #
+        Timestamps = Timestamps.astype(np.float32, copy=False)
+        Displacements = Displacements.astype(np.float32, copy=False)
+        StartAndEndSeparation = StartAndEndSeparation.astype(np.float32, copy=False)
 
         plt.figure(testNumber)
         plt.plot(Timestamps, Displacements, label='distance to destination')
@@ -124,19 +264,24 @@ def SimulateConstantVelocityTravel(InitialDisplacement, hubbleModel, testNumber)
         plt.ylabel('displacement (Mpc)')
         plt.title(universe.name)
         plt.legend()
-        plt.show()
+
+        if headless:
+            plt.savefig('test%d.png' % testNumber, dpi=120)
+            plt.close()
 
 def main(argv):
     distance = float(argv[1])
     InitialDisplacement = MpcToMetres(distance) 
     
     # Run the simulation for all universes.  This could just iterate through a list, but I made it a
-    # dictionary just in case it was useful to specify it by string.
+    # dictionary just in case it was useful to specify it by string.  Every run is finished before
+    # any figure is shown so that a blocking plot window doesn't hold up the next simulation.
     #
-    testNumber = 1
-    SimulateConstantVelocityTravel(InitialDisplacement, 'static', testNumber)
-    testNumber += 1
-    SimulateConstantVelocityTravel(InitialDisplacement, 'linear', testNumber)
+    for testNumber, hubbleModel in enumerate(universes, 1):
+        SimulateConstantVelocityTravel(InitialDisplacement, hubbleModel, testNumber)
+
+    if not headless:
+        plt.show()
 
 if __name__ == "__main__":
     main(sys.argv)